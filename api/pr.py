@@ -1,89 +1,315 @@
 import asyncio
+import collections
+import functools
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
+import string
 import sys
-import traceback
+import time
 
 import aiohttp
 from blacksheep import Application, Response
 import cachetools
+import gidgethub
 from gidgethub import aiohttp as gh_aiohttp
-from gidgethub import routing
+from gidgethub import abc as gh_abc
 from gidgethub import sansio
 from gidgethub.apps import get_installation_access_token
+import orjson
 
-from unidiff import PatchSet
+log = logging.getLogger(__name__)
+log_listener = None
 
-router = routing.Router()
-cache = cachetools.LRUCache(maxsize=500)
+
+def start_logging():
+    # Records are written to stderr from the listener's thread, not the event loop.
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stderr))
+    log.handlers = [logging.handlers.QueueHandler(log_queue)]
+    # Keep records away from any handlers the host set up on the root logger.
+    log.propagate = False
+    try:
+        log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    except ValueError:
+        log.setLevel(logging.INFO)
+    log_listener.start()
+
+
+# Set up at import, the host may not send lifespan events.
+start_logging()
+
+cache = cachetools.TTLCache(maxsize=1000, ttl=300)
+session = None
+session_loop = None
+
+
+def get_session():
+    # Created on first use: the host may not send lifespan events and may run
+    # each delivery on a fresh event loop, which a session cannot outlive.
+    global session, session_loop
+    loop = asyncio.get_running_loop()
+    if session is None or session.closed or session_loop is not loop:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75)
+        )
+        session_loop = loop
+    return session
+
+
+locks = None
+locks_loop = None
+
+
+def get_lock(key):
+    # asyncio locks are bound to the loop they are first used on, so like the
+    # session they are recreated whenever deliveries move to a new loop.
+    global locks, locks_loop
+    loop = asyncio.get_running_loop()
+    if locks_loop is not loop:
+        locks = collections.defaultdict(asyncio.Lock)
+        locks_loop = loop
+    return locks[key]
+
+
+class Throttle:
+    """Token bucket allowing `rate` requests per second in bursts of `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.pause_until = 0
+
+    def pause(self, seconds):
+        self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    async def resume(self):
+        """Wait out a pause without taking a token."""
+        while (delay := self.pause_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def acquire(self):
+        async with get_lock(self):
+            while True:
+                now = time.monotonic()
+                if now < self.pause_until:
+                    await asyncio.sleep(self.pause_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Stay below GitHub's secondary rate limit of 80 content-creating requests
+# per minute. Reads are not counted against it and only honour pauses.
+throttle = Throttle(rate=80 / 60, burst=10)
+WRITE_METHODS = frozenset({"POST", "PATCH", "PUT", "DELETE"})
+
+
+class GitHubAPI(gh_aiohttp.GitHubAPI):
+    """GitHub client sharing the module-wide throttle and encoding JSON with orjson."""
+
+    async def post(self, url, url_vars={}, *, data, content_type=gh_abc.JSON_CONTENT_TYPE, **kwargs):
+        # gidgethub passes bodies of any other content type through untouched.
+        # b"" is its "no body" sentinel and must stay as is.
+        if content_type == gh_abc.JSON_CONTENT_TYPE and data != b"":
+            data = orjson.dumps(data)
+            content_type = "application/json; charset=utf-8"
+        return await super().post(url, url_vars, data=data, content_type=content_type, **kwargs)
+
+    async def getpage(self, url, url_vars={}, *, accept=sansio.accept_format()):
+        """Fetch one page of a listing, returning it with the next page's URL (or None).
+
+        Unlike getiter, which keeps every page referenced until iteration ends,
+        this lets callers drop a page before fetching the next one.
+        """
+        return await self._make_request("GET", url, url_vars, b"", accept)
+
+    async def _throttle(self, method):
+        if method in WRITE_METHODS:
+            await throttle.acquire()
+        else:
+            await throttle.resume()
+
+    async def _request(self, method, url, headers, body=b""):
+        await self._throttle(method)
+        status, response_headers, response_body = await super()._request(method, url, headers, body)
+        if status in (403, 429) and "retry-after" in response_headers:
+            # Secondary rate limit hit: hold back every request, then retry once.
+            throttle.pause(int(response_headers["retry-after"]))
+            await self._throttle(method)
+            status, response_headers, response_body = await super()._request(method, url, headers, body)
+        return status, response_headers, response_body
+
+
+INSTALLATION_ID = "23363758"
+APP_ID = "173391"
+
+# Installation tokens are valid for an hour; refresh them a bit earlier.
+token_cache = cachetools.TTLCache(maxsize=8, ttl=3000)
+
+
+async def get_access_token(installation_id):
+    async with get_lock("token"):
+        token = token_cache.get(installation_id)
+        if token is None:
+            response = await get_installation_access_token(
+                gh=GitHubAPI(get_session(), "paperless-ngx/paperless-ngx"),
+                installation_id=installation_id,
+                app_id=APP_ID,
+                private_key=os.environ.get("PRIVATE_KEY")
+            )
+            token = token_cache[installation_id] = response["token"]
+        return token
+
+
+async def cached(key, fetch):
+    # Concurrent deliveries wait for a single in-flight fetch per key.
+    async with get_lock(("cache", key)):
+        value = cache.get(key)
+        if value is None:
+            value = cache[key] = await fetch()
+        return value
+
+
+async def get_members(gh):
+    async def fetch():
+        return {m["login"] async for m in gh.getiter("/orgs/paperless-ngx/members")}
+
+    return await cached("members", fetch)
+
+
+# Added/removed lines with at least three characters left after stripping
+# whitespace ('{' etc. are ignored), captured without the surrounding whitespace.
+ADDED_LINE_RE = re.compile(r"^\+[ \t]*(\S.+\S)", re.M)
+REMOVED_LINE_RE = re.compile(r"^-[ \t]*(\S.+\S)", re.M)
+
+# Team labels, the team with bit 1 << i is TEAMS[i].
+TEAMS = ("backend", "frontend", "documentation", "ci-cd")
+# Bit of the team responsible for each top-level directory (or file) of the repository.
+RESPONSIBLE = {
+    "src": 1 << TEAMS.index("backend"),
+    "requirements.txt": 1 << TEAMS.index("backend"),
+    "src-ui": 1 << TEAMS.index("frontend"),
+    "docs": 1 << TEAMS.index("documentation"),
+    ".github": 1 << TEAMS.index("ci-cd"),
+}
+
+
+def get_responsible_teams(diffs):
+    teams = 0
+    for diff in diffs:
+        teams |= RESPONSIBLE.get(diff["filename"].split("/", 1)[0], 0)
+    return [team for i, team in enumerate(TEAMS) if teams >> i & 1]
+
+
+def count_added_lines(added, removed):
+    """Count added lines that carry information.
+
+    Like Git's xprepare, added lines that are too frequent on the removed
+    side (e.g. reformatted imports or braces) are ignored.
+    """
+    removed_counts = collections.Counter(removed)
+    limit = math.isqrt(len(added) + len(removed))
+    return sum(n for line, n in collections.Counter(added).items() if removed_counts[line] <= limit)
+
+
+def parse_file(file):
+    """Reduce an entry of the PR's file listing to a {"filename", "size"} dict.
+
+    GitHub leaves out the patch of binary and very large files, for those
+    only its "additions" count is known.
+    """
+    patch = file.get("patch")
+    if patch is None:
+        size = file["additions"]
+    else:
+        size = count_added_lines(ADDED_LINE_RE.findall(patch), REMOVED_LINE_RE.findall(patch))
+    return {"filename": file["filename"], "size": size}
 
 
-def get_responsible_teams(diff):
-    responsible = [
-        ("src/", "backend"),
-        ("requirements.txt", "backend"),
-        ("src-ui/", "frontend"),
-        ("docs/", "documentation"),
-        (".github/", "ci-cd")
-    ]
-    teams = set()
-    for change in diff:
-        for responsibility, team in responsible:
-            if change.path.startswith(responsibility):
-                teams.add(team)
-    return teams
+def parse_files(files):
+    return [parse_file(file) for file in files]
 
 
-def get_change_size(diff):
+def get_change_size(diffs):
     size = 0
     ignore_types = ["rst", "md", "txt", "lock"]
-    for change in diff:
-        if change.path.split(".")[-1] not in ignore_types:
-            for hunk in change:
-                for line in hunk:
-                    # Ignore whitespace and single-char lines ('{' etc.)
-                    if line.is_added and len(line.value.strip()) > 2:
-                        print(f">OOOO{size} {line}")
-                        size += 1
+    for diff in diffs:
+        if diff["filename"].split(".")[-1] not in ignore_types:
+            size += diff["size"]
     return size
 
 
-new_pr_template = r"""
-Hello @{user},
+new_pr_template = string.Template(r"""
+Hello @$user,
 
 Thank you very much for submitting this PR to us!
 
 This is what will happen next:
 
 1. Once enabled by a maintainer, our ci tests will run against your PR to ensure quality and consistency.
-2. Next, human contributors from paperless-ngx review your changes. {review_conditions}
+2. Next, human contributors from paperless-ngx review your changes. $review_conditions
 3. Please address any issues that come up during the review as soon as you are able to.
 4. If accepted, your pull request will be merged into the `dev` branch and changes there will be tested further.
 5. Eventually, changes from you and other contributors will be merged into `main` and a new release will be made.
 
 You'll be hearing from us soon, and thank you again for contributing to our project.
-"""
+""")
 
 
-@router.register("pull_request", action="opened")
-async def opened_pr(event, gh, *arg, **kwargs):
+async def retry_not_found(fetch, tries=4):
+    # Webhooks can arrive before GitHub's API has caught up with the event.
+    for attempt in range(tries):
+        try:
+            return await fetch()
+        except gidgethub.BadRequest as exc:
+            if exc.status_code not in (404, 409) or attempt == tries - 1:
+                raise
+            await asyncio.sleep(0.05 * 4 ** attempt)
+
+
+async def get_diffs(gh, pull_request):
+    diffs = []
+    url = pull_request["url"] + "/files?per_page=100"
+    while url is not None:
+        page, url = await retry_not_found(functools.partial(gh.getpage, url))
+        # Scanning the patches is CPU-bound, keep it off the event loop.
+        diffs += await asyncio.to_thread(parse_files, page)
+        # Only the reduced dicts are kept, not the page and its patches.
+        del page
+    return diffs
+
+
+async def opened_pr(event, gh):
     """Mark new PRs as needing a review."""
     pull_request = event.data["pull_request"]
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(pull_request["patch_url"]) as resp:
-            patch = PatchSet(await resp.text())
-
-    members = await gh.getitem("/orgs/paperless-ngx/members")
-    members = [m["login"] for m in members]
-
     user = pull_request["user"]["login"]
     if "github-actions" in user:
-        print(f"ignoring PR from {user}")
+        log.debug("ignoring PR from %s", user)
         return
 
+    # The changed files and the member list are independent, fetch them concurrently.
+    diffs, members = await asyncio.gather(
+        get_diffs(gh, pull_request),
+        get_members(gh),
+    )
+
     labels = []
-    small_change = get_change_size(patch) < 10
-    responsible = get_responsible_teams(patch)
+    small_change = get_change_size(diffs) < 10
+    responsible = get_responsible_teams(diffs)
 
     is_dependency_pr = "dependabot" in user
     is_translation_pr = "paperlessngx-bot" in user
@@ -101,58 +327,71 @@ async def opened_pr(event, gh, *arg, **kwargs):
     if is_translation_pr:
         labels = ["skip-changelog", "translation"]
 
-    await gh.post(pull_request["issue_url"] + "/labels", data=labels)
+    posts = [gh.post(pull_request["issue_url"] + "/labels", data=labels)]
 
     if is_dependency_pr or is_translation_pr:
-        print(f"ignoring comment for auto-generated PR")
-        return
-
-    if user in members:
-        print("Ignoring comment for org members")
-        return
-
-    if small_change:
-        review_conditions = "Since this seems to be a small change, only a single contributor has to review your changes."
+        log.debug("ignoring comment for auto-generated PR")
+    elif user in members:
+        log.debug("ignoring comment for org members")
     else:
-        review_conditions = "Since this is a non-trivial change, a review from at least two contributors is required."
+        if small_change:
+            review_conditions = "Since this seems to be a small change, only a single contributor has to review your changes."
+        else:
+            review_conditions = "Since this is a non-trivial change, a review from at least two contributors is required."
+
+        comment = new_pr_template.substitute(user=user, review_conditions=review_conditions)
+        log.debug("commenting on %s: %s", pull_request["comments_url"], comment)
+        posts.append(gh.post(pull_request["comments_url"], data={"body": comment}))
 
-    comment = new_pr_template.format(user=user, review_conditions=review_conditions)
-    print(pull_request["comments_url"], {"body": comment})
-    await gh.post(pull_request["comments_url"], data={"body": comment})
+    await asyncio.gather(*posts)
 
 
 app = Application()
 
 
+@app.on_start
+async def resume_logging(application):
+    start_logging()
+
+
+@app.on_stop
+async def stop_logging(application):
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+@app.on_stop
+async def close_session(application):
+    if session is not None:
+        await session.close()
+
+
 @app.router.post("/api/pr")
 async def main(request):
     try:
-        async with aiohttp.ClientSession() as session:
-            access_token_response = await get_installation_access_token(
-                gh=gh_aiohttp.GitHubAPI(session, "paperless-ngx/paperless-ngx"),
-                installation_id="23363758",
-                app_id="173391",
-                private_key=os.environ.get("PRIVATE_KEY")
-            )
+        access_token = await get_access_token(INSTALLATION_ID)
         body = await request.read()
         secret = os.environ.get("GH_SECRET")
         headers = {k.decode(): v.decode() for k, v in request.headers.items()}
         event = sansio.Event.from_http(headers, body, secret=secret)
-        print('GH delivery ID', event.delivery_id, file=sys.stderr)
+        log.info("GH delivery ID %s", event.delivery_id)
         if event.event == "ping":
             return Response(200)
-        async with aiohttp.ClientSession() as session:
-            gh = gh_aiohttp.GitHubAPI(session, "paperless-ngx/paperless-ngx",
-                                      oauth_token=access_token_response["token"],
-                                      cache=cache)
-            # Give GitHub some time to reach internal consistency.
-            await asyncio.sleep(1)
-            await router.dispatch(event, gh)
+        gh = GitHubAPI(get_session(), "paperless-ngx/paperless-ngx",
+                       oauth_token=access_token)
+        # opened_pr is the only handler, so skip gidgethub's generic router.
+        if event.event == "pull_request" and event.data.get("action") == "opened":
+            await opened_pr(event, gh)
         try:
-            print('GH requests remaining:', gh.rate_limit.remaining)
+            log.debug("GH requests remaining: %s", gh.rate_limit.remaining)
         except AttributeError:
             pass
         return Response(200)
     except Exception as exc:
-        traceback.print_exc(file=sys.stderr)
+        if isinstance(exc, gidgethub.BadRequest) and exc.status_code == 401:
+            # The cached installation token was revoked, mint a new one next time.
+            token_cache.pop(INSTALLATION_ID, None)
+        log.exception("webhook failure")
         return Response(500)